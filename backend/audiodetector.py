@@ -11,13 +11,32 @@ YamNet output: (batch, 521) — logits over AudioSet classes
 import csv
 import time
 import logging
-import base64
+import threading
 from pathlib import Path
 
 import numpy as np
 
+from ortconfig import ORT_INTRA_OP_THREADS
+
+# SIMD base64 decoder with the stdlib API; fall back to the stdlib one
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
 logger = logging.getLogger("arcflow.audiodetector")
 
+# scipy's pocketfft can spread the per-frame transforms across cores —
+# capped at the same per-session budget as the ORT sessions
+try:
+    import scipy.fft as _sp_fft
+
+    def _rfft(frames: np.ndarray, n: int) -> np.ndarray:
+        return _sp_fft.rfft(frames, n=n, axis=-1, workers=ORT_INTRA_OP_THREADS)
+except ImportError:
+    def _rfft(frames: np.ndarray, n: int) -> np.ndarray:
+        return np.fft.rfft(frames, n=n, axis=-1)
+
 # ─── Mel-spectrogram constants ───
 SAMPLE_RATE = 16000
 STFT_WINDOW = 400       # 25ms at 16kHz
@@ -28,6 +47,8 @@ MEL_FMIN = 125.0
 MEL_FMAX = 7500.0
 PATCH_FRAMES = 96        # YamNet expects 96 frames per patch
 PATCH_HOP = 48           # Overlap patches by half
+MAX_CLIP_SECONDS = 60    # Longest PCM clip accepted from a client
+MAX_PCM_BYTES = SAMPLE_RATE * 4 * MAX_CLIP_SECONDS
 
 
 def _hz_to_mel(hz: float) -> float:
@@ -45,58 +66,59 @@ def _build_mel_filterbank(
     mel_min = _hz_to_mel(fmin)
     mel_max = _hz_to_mel(fmax)
     mels = np.linspace(mel_min, mel_max, num_mels + 2)
-    hz_points = np.array([_mel_to_hz(m) for m in mels])
+    hz_points = _mel_to_hz(mels)  # ufunc arithmetic, works on the whole array
     bin_points = np.floor((nfft + 1) * hz_points / sr).astype(int)
 
-    n_freqs = nfft // 2 + 1
-    filterbank = np.zeros((num_mels, n_freqs), dtype=np.float32)
-
-    for i in range(num_mels):
-        left = bin_points[i]
-        center = bin_points[i + 1]
-        right = bin_points[i + 2]
-
-        for j in range(left, center):
-            if center != left:
-                filterbank[i, j] = (j - left) / (center - left)
-        for j in range(center, right):
-            if right != center:
-                filterbank[i, j] = (right - j) / (right - center)
-
-    return filterbank
+    # All triangles at once on a (num_mels, n_freqs) grid: rising edge on
+    # [left, center), falling edge on [center, right), zero elsewhere
+    bins = np.arange(nfft // 2 + 1)[None, :]
+    left = bin_points[:-2, None]
+    center = bin_points[1:-1, None]
+    right = bin_points[2:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):  # empty edges divide by 0
+        rising = (bins - left) / (center - left)
+        falling = (right - bins) / (right - center)
+    filterbank = np.where(
+        (bins >= left) & (bins < center), rising,
+        np.where((bins >= center) & (bins < right), falling, 0.0),
+    )
+    return filterbank.astype(np.float32)
 
 
 def _stft_magnitude(signal: np.ndarray, window_len: int, hop: int, nfft: int) -> np.ndarray:
-    """Compute STFT magnitude spectrogram using numpy. Returns (n_frames, nfft//2+1)."""
-    window = np.hanning(window_len).astype(np.float32)
+    """Compute STFT magnitude spectrogram using numpy. Returns (n_frames, nfft//2+1) float32."""
+    signal = np.asarray(signal, dtype=np.float32)
+    window = _HANN if window_len == STFT_WINDOW else np.hanning(window_len).astype(np.float32)
     # Pad signal if needed
     n_frames = max(1, 1 + (len(signal) - window_len) // hop)
     pad_len = (n_frames - 1) * hop + window_len
     if len(signal) < pad_len:
         signal = np.pad(signal, (0, pad_len - len(signal)))
 
-    frames = np.stack([
-        signal[i * hop : i * hop + window_len] * window
-        for i in range(n_frames)
-    ])
-    spectrum = np.fft.rfft(frames, n=nfft)
-    return np.abs(spectrum)
-
-
-# Pre-build the mel filterbank (singleton)
-_mel_fb: np.ndarray | None = None
+    # Overlapping frames as a strided view of the signal; the window multiply
+    # is the only copy, straight into one contiguous (n_frames, window_len) block
+    frames = np.lib.stride_tricks.sliding_window_view(signal, window_len)[::hop] * window
+    spectrum = _rfft(frames, nfft)
+    # NumPy < 2 always returns complex128 here; keep magnitudes float32 so the
+    # mel projection in _preprocess runs as a single-precision GEMM
+    return np.abs(spectrum).astype(np.float32, copy=False)
 
 
-def _get_mel_fb() -> np.ndarray:
-    global _mel_fb
-    if _mel_fb is None:
-        _mel_fb = _build_mel_filterbank(MEL_BANDS, STFT_NFFT, SAMPLE_RATE, MEL_FMIN, MEL_FMAX)
-    return _mel_fb
+# Fixed front-end constants, built once at import (both are cheap to build).
+# The filterbank is stored pre-transposed, (n_freqs, 64), so the projection
+# in _preprocess reads a contiguous right-hand operand.
+_HANN = np.hanning(STFT_WINDOW).astype(np.float32)
+_MEL_FB_T = np.ascontiguousarray(
+    _build_mel_filterbank(MEL_BANDS, STFT_NFFT, SAMPLE_RATE, MEL_FMIN, MEL_FMAX).T
+)
 
 
 def _softmax(x: np.ndarray) -> np.ndarray:
-    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
-    return e / np.sum(e, axis=-1, keepdims=True)
+    """Row-wise softmax computed in place — x is overwritten and returned."""
+    x -= np.max(x, axis=-1, keepdims=True)
+    np.exp(x, out=x)
+    x /= np.sum(x, axis=-1, keepdims=True)
+    return x
 
 
 class AudioDetector:
@@ -113,6 +135,8 @@ class AudioDetector:
         self.session = None
         self._loaded = False
         self._use_cpu = use_cpu
+        self._batch_capable = False
+        self._tls = threading.local()  # per-thread IOBinding (classify runs on executor threads)
         self.labels: list[str] = []
 
         self._load_labels(labels_path)
@@ -149,6 +173,7 @@ class AudioDetector:
 
             provider_options = []
             preferred = []
+            ctx_to_write = None
 
             if self._use_cpu:
                 logger.info("CPU-only mode for AudioDetector")
@@ -164,13 +189,17 @@ class AudioDetector:
                         "backend_path": "QnnHtp.dll",
                         "htp_performance_mode": "burst",
                         "htp_graph_finalization_optimization_mode": "3",
-                        "enable_htp_fp16_precision": "1",
-                        "ep_context_enable": "1",
-                        "ep_context_file_path": ctx_binary,
                     }
+                    # A QDQ (int8) export runs natively on the HTP; fp16 is
+                    # only for float models
+                    if "int8" not in Path(path).stem:
+                        qnn_opts["enable_htp_fp16_precision"] = "1"
                     if Path(ctx_binary).exists():
                         logger.info(f"Loading cached QNN context: {ctx_binary}")
                         path = ctx_binary
+                    else:
+                        logger.info(f"Compiling QNN graph (context will be cached to {ctx_binary})")
+                        ctx_to_write = ctx_binary
                     provider_options.append(qnn_opts)
 
                 if "DmlExecutionProvider" in providers:
@@ -182,6 +211,14 @@ class AudioDetector:
 
             sess_opts = ort.SessionOptions()
             sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            sess_opts.intra_op_num_threads = ORT_INTRA_OP_THREADS
+            sess_opts.inter_op_num_threads = 1
+            sess_opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            sess_opts.enable_mem_pattern = True   # planned per batch size; a node's clip length rarely changes
+            sess_opts.enable_cpu_mem_arena = True
+            if ctx_to_write:
+                sess_opts.add_session_config_entry("ep.context_enable", "1")
+                sess_opts.add_session_config_entry("ep.context_file_path", ctx_to_write)
 
             self.session = ort.InferenceSession(
                 path,
@@ -193,11 +230,16 @@ class AudioDetector:
 
             active = self.session.get_providers()
             input_info = self.session.get_inputs()[0]
+            self._input_name = input_info.name  # cached for classify()
+            self._output_name = self.session.get_outputs()[0].name
+            # A symbolic/dynamic leading dim means all patches can go in one run
+            batch_dim = input_info.shape[0] if input_info.shape else 1
+            self._batch_capable = not isinstance(batch_dim, int) or batch_dim <= 0
             output_info = [o.name for o in self.session.get_outputs()]
 
             logger.info(f"AudioDetector model loaded: {path}")
             logger.info(f"  Active providers: {active}")
-            logger.info(f"  Input: {input_info.name} {input_info.shape}")
+            logger.info(f"  Input: {input_info.name} {input_info.shape} (batched: {self._batch_capable})")
             logger.info(f"  Outputs: {output_info}")
         except Exception as e:
             logger.error(f"Failed to load AudioDetector model: {e}")
@@ -207,6 +249,26 @@ class AudioDetector:
     def loaded(self) -> bool:
         return self._loaded
 
+    def _run_bound(self, batch: np.ndarray) -> np.ndarray:
+        """Run a contiguous float32 patch batch through this thread's IOBinding.
+
+        The patches are bound in place (no feed copy into an ORT tensor). The
+        output binding is kept per thread and only redone when the number of
+        patches changes, since ORT pins the output shape after the first run.
+        Returns the logits.
+        """
+        io = getattr(self._tls, "io_binding", None)
+        if io is None:
+            io = self._tls.io_binding = self.session.io_binding()
+            self._tls.bound_rows = None
+        if self._tls.bound_rows != batch.shape[0]:
+            io.clear_binding_outputs()
+            io.bind_output(self._output_name, "cpu")
+            self._tls.bound_rows = batch.shape[0]
+        io.bind_cpu_input(self._input_name, batch)
+        self.session.run_with_iobinding(io)
+        return io.copy_outputs_to_cpu()[0]
+
     def _preprocess(self, pcm: np.ndarray) -> np.ndarray:
         """Convert 16kHz PCM float32 to mel-spectrogram patches for YamNet.
         Returns shape (N, 1, 96, 64).
@@ -216,70 +278,86 @@ class AudioDetector:
         # mag shape: (n_frames, 257)
 
         # Apply mel filterbank
-        mel_fb = _get_mel_fb()
-        mel_spec = mag @ mel_fb.T  # (n_frames, 64)
+        mel_spec = mag @ _MEL_FB_T  # (n_frames, 64)
 
-        # Log scale
-        mel_spec = np.log(mel_spec + 0.001)
+        # Log scale, in place on the fresh GEMM output (no temporaries)
+        np.add(mel_spec, 0.001, out=mel_spec)
+        np.log(mel_spec, out=mel_spec)
 
         # Frame into 96-frame patches
         n_frames = mel_spec.shape[0]
-        patches = []
-        start = 0
-        while start + PATCH_FRAMES <= n_frames:
-            patch = mel_spec[start : start + PATCH_FRAMES]  # (96, 64)
-            patches.append(patch)
-            start += PATCH_HOP
-
-        if len(patches) == 0:
+        if n_frames < PATCH_FRAMES:
             # Pad to minimum size
-            padded = np.zeros((PATCH_FRAMES, MEL_BANDS), dtype=np.float32)
-            padded[:n_frames] = mel_spec[:PATCH_FRAMES]
-            patches.append(padded)
-
-        batch = np.stack(patches)  # (N, 96, 64)
-        batch = batch[:, np.newaxis, :, :]  # (N, 1, 96, 64)
-        return batch.astype(np.float32)
-
-    def classify(self, pcm: np.ndarray, top_n: int = 10) -> list[dict]:
-        """Run classification on PCM float32 array. Returns top-N results."""
+            batch = np.zeros((1, 1, PATCH_FRAMES, MEL_BANDS), dtype=np.float32)
+            batch[0, 0, :n_frames] = mel_spec
+            return batch
+
+        # Overlapping patches as a strided view, copied once straight into
+        # the float32 (N, 1, 96, 64) batch — no per-patch list/stack/astype.
+        windows = np.lib.stride_tricks.sliding_window_view(mel_spec, PATCH_FRAMES, axis=0)
+        windows = windows[::PATCH_HOP].transpose(0, 2, 1)  # (N, 96, 64)
+        batch = np.empty((windows.shape[0], 1, PATCH_FRAMES, MEL_BANDS), dtype=np.float32)
+        batch[:, 0] = windows
+        return batch
+
+    def classify(self, pcm: np.ndarray, top_n: int = 10, conf: float | None = None) -> list[dict]:
+        """Run classification on PCM float32 array. Returns top-N results.
+
+        conf overrides self.confidence for this call only.
+        """
         if not self._loaded or self.session is None:
             return []
+        if conf is None:
+            conf = self.confidence
 
         t0 = time.perf_counter()
 
         patches = self._preprocess(pcm)  # (N, 1, 96, 64)
-        input_name = self.session.get_inputs()[0].name
-
-        # YamNet only accepts batch=1 — run each patch individually
-        all_probs = []
-        for i in range(patches.shape[0]):
-            single = patches[i : i + 1]  # (1, 1, 96, 64)
-            outputs = self.session.run(None, {input_name: single})
-            logits = outputs[0]  # (1, 521)
-            probs = _softmax(logits)
-            all_probs.append(probs[0])
 
-        # Average across patches
-        avg_probs = np.mean(np.stack(all_probs), axis=0)  # (521,)
+        # Logits come back as fresh arrays, so softmax can run in place on them
+        if self._batch_capable:
+            # One run for the whole clip instead of one per patch
+            all_probs = _softmax(self._run_bound(patches))  # (N, 521)
+        else:
+            # Fixed batch=1 export — run each patch individually
+            all_probs = None
+            for i in range(patches.shape[0]):
+                probs = _softmax(self._run_bound(patches[i : i + 1]))  # (1, 521)
+                if all_probs is None:
+                    all_probs = np.empty((patches.shape[0], probs.shape[1]), dtype=probs.dtype)
+                all_probs[i] = probs[0]
+
+        # Average the per-patch probabilities (not the logits — a confident
+        # single patch should still stand out in a mostly quiet clip)
+        avg_probs = np.mean(all_probs, axis=0)  # (521,)
 
         # Top-N above confidence threshold
         top_indices = np.argsort(avg_probs)[::-1][:top_n]
         results = []
         for idx in top_indices:
-            conf = float(avg_probs[idx])
-            if conf < self.confidence:
+            prob = float(avg_probs[idx])
+            if prob < conf:
                 break
             label = self.labels[idx] if idx < len(self.labels) else f"class_{idx}"
-            results.append({"label": label, "confidence": round(conf, 4)})
+            results.append({"label": label, "confidence": round(prob, 4)})
 
         dt = (time.perf_counter() - t0) * 1000
         logger.debug(f"AudioDetector inference: {dt:.1f}ms, {len(results)} detections")
 
         return results
 
-    def classify_from_base64(self, b64_str: str, top_n: int = 10) -> list[dict]:
+    def classify_from_base64(
+        self, b64_str: str, top_n: int = 10, conf: float | None = None
+    ) -> list[dict]:
         """Decode base64 float32 PCM and classify."""
-        raw = base64.b64decode(b64_str)
+        # Reject oversized clips before allocating the decoded buffer
+        if len(b64_str) > MAX_PCM_BYTES * 4 // 3 + 4:
+            logger.warning(f"Audio clip too large ({len(b64_str)} base64 chars) — skipped")
+            return []
+
+        try:
+            raw = base64.b64decode(b64_str)
+        except ValueError:
+            return []
         pcm = np.frombuffer(raw, dtype=np.float32)
-        return self.classify(pcm, top_n)
+        return self.classify(pcm, top_n, conf)
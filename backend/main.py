@@ -12,15 +12,28 @@ import asyncio
 import json
 import logging
 import os
+import re
+import threading
+import time
 import uuid
 from contextlib import asynccontextmanager
 from pathlib import Path
 
+import numpy as np
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj)
+
 from reasoning import ReasoningBrain
-from watchdog import Watchdog
+from watchdog import Watchdog, MAX_IMAGE_BYTES
 from audiodetector import AudioDetector
 
 # ─── Qualcomm AI Hub Configuration ───
@@ -49,43 +62,70 @@ logger = logging.getLogger("arcflow")
 # ─── AI Engine ───
 brain = ReasoningBrain()
 
+# One generation at a time: the VLM/LLM share the NPU, and queued requests
+# wait here instead of each parking an executor thread that YOLO/YamNet need.
+_brain_sem = asyncio.Semaphore(1)
+
+
+async def _run_brain(fn, *args):
+    """Run a blocking ReasoningBrain call in the executor, serialized."""
+    async with _brain_sem:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
 # ─── YOLO Object Detection ───
 _watchdog: Watchdog | None = None
+_watchdog_lock = threading.Lock()
 
 def _get_watchdog() -> Watchdog | None:
+    """Lazy-load the YOLO session. Blocking — call from an executor thread."""
     global _watchdog
-    if _watchdog is None:
-        model_dir = Path(__file__).parent / "models"
-        model_path = model_dir / "yolov8n.onnx"
-        if model_path.exists():
-            try:
-                _watchdog = Watchdog(str(model_path), confidence=0.45, use_cpu=True)
-                logger.info(f"Watchdog loaded from {model_path}")
-            except Exception as e:
-                logger.warning(f"Could not load Watchdog: {e}")
-        else:
-            logger.warning(f"YOLO model not found at {model_path}")
+    if _watchdog is not None:
+        return _watchdog
+    with _watchdog_lock:
+        if _watchdog is None:
+            model_dir = Path(__file__).parent / "models"
+            # Prefer an INT8 (QDQ) export when one has been dropped in — it is
+            # native on the HTP and roughly halves memory traffic on CPU.
+            model_path = model_dir / "yolov8n_int8.onnx"
+            if not model_path.exists():
+                model_path = model_dir / "yolov8n.onnx"
+            if model_path.exists():
+                try:
+                    _watchdog = Watchdog(str(model_path), confidence=0.45, use_cpu=True)
+                    logger.info(f"Watchdog loaded from {model_path}")
+                except Exception as e:
+                    logger.warning(f"Could not load Watchdog: {e}")
+            else:
+                logger.warning(f"YOLO model not found at {model_path}")
     return _watchdog
 
 # ─── YamNet Audio Detection ───
 _audio_detector: AudioDetector | None = None
+_audio_detector_lock = threading.Lock()
 
 def _get_audio_detector() -> AudioDetector | None:
+    """Lazy-load the YamNet session. Blocking — call from an executor thread."""
     global _audio_detector
-    if _audio_detector is None:
-        model_dir = Path(__file__).parent / "models"
-        model_path = model_dir / "yamnet.onnx"
-        labels_path = model_dir / "yamnet_class_map.csv"
-        if model_path.exists() and labels_path.exists():
-            try:
-                _audio_detector = AudioDetector(
-                    str(model_path), str(labels_path), confidence=0.15, use_cpu=True
-                )
-                logger.info(f"AudioDetector loaded from {model_path}")
-            except Exception as e:
-                logger.warning(f"Could not load AudioDetector: {e}")
-        else:
-            logger.warning(f"YamNet model or labels not found in {model_dir}")
+    if _audio_detector is not None:
+        return _audio_detector
+    with _audio_detector_lock:
+        if _audio_detector is None:
+            model_dir = Path(__file__).parent / "models"
+            model_path = model_dir / "yamnet_int8.onnx"  # QDQ export, if provided
+            if not model_path.exists():
+                model_path = model_dir / "yamnet.onnx"
+            labels_path = model_dir / "yamnet_class_map.csv"
+            if model_path.exists() and labels_path.exists():
+                try:
+                    _audio_detector = AudioDetector(
+                        str(model_path), str(labels_path), confidence=0.15, use_cpu=True
+                    )
+                    logger.info(f"AudioDetector loaded from {model_path}")
+                except Exception as e:
+                    logger.warning(f"Could not load AudioDetector: {e}")
+            else:
+                logger.warning(f"YamNet model or labels not found in {model_dir}")
     return _audio_detector
 
 DEFAULT_PROMPT = "Describe what you see. If there is any safety concern, explain it."
@@ -110,6 +150,24 @@ async def lifespan(app: FastAPI):
 
     asyncio.create_task(_load_brain())
 
+    async def _load_detectors():
+        # Build the ONNX sessions and run one dummy inference each so the first
+        # real frame doesn't pay for session creation / QNN graph finalization.
+        try:
+            watchdog = await loop.run_in_executor(None, _get_watchdog)
+            if watchdog is not None and watchdog.loaded:
+                dummy_frame = np.zeros((480, 640, 3), dtype=np.uint8)
+                await loop.run_in_executor(None, watchdog.detect, dummy_frame)
+            detector = await loop.run_in_executor(None, _get_audio_detector)
+            if detector is not None and detector.loaded:
+                dummy_pcm = np.zeros(16000, dtype=np.float32)
+                await loop.run_in_executor(None, detector.classify, dummy_pcm)
+            logger.info("Detectors warmed up")
+        except Exception as e:
+            logger.warning(f"Detector warmup failed: {e}")
+
+    asyncio.create_task(_load_detectors())
+
     if not os.environ.get("ARCFLOW_SMTP_USER"):
         logger.warning("ARCFLOW_SMTP_USER not set — Email node will not work")
     if not os.environ.get("TWILIO_ACCOUNT_SID"):
@@ -139,6 +197,7 @@ async def health():
     return {
         "status": "ok",
         "vlm_loaded": brain.vlm_loaded,
+        "llm_cache": brain.cache_stats(),
     }
 
 
@@ -162,7 +221,7 @@ class ConnectionManager:
         ws = self.active.get(cid)
         if ws:
             try:
-                await ws.send_json({"type": msg_type, "payload": payload})
+                await ws.send_text(_dumps({"type": msg_type, "payload": payload}))
             except Exception:
                 self.disconnect(cid)
 
@@ -173,12 +232,65 @@ manager = ConnectionManager()
 _client_state: dict[str, dict] = {}
 
 
+def _spawn_handler(cid: str, coro) -> None:
+    """Run a message handler as a task so the receive loop keeps reading
+    (e.g. the next frame arrives while YOLO or the VLM is still busy)."""
+    task = asyncio.create_task(coro)
+    tasks = _client_state[cid]["tasks"]
+    tasks.add(task)
+
+    def _done(t: asyncio.Task):
+        tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"Handler error ({cid}): {t.exception()}")
+
+    task.add_done_callback(_done)
+
+
+def _submit_latest(cid: str, msg_type: str, payload: dict, handler) -> None:
+    """Latest-frame policy for per-node inference requests.
+
+    While a node's request is in flight, newer ones overwrite a single pending
+    slot, so a slow model only ever sees the freshest frame instead of working
+    through a backlog of stale ones.
+    """
+    state = _client_state[cid]
+    key = (msg_type, payload.get("node_id", ""))
+    if key in state["inflight"]:
+        if key in state["pending"]:
+            logger.debug(f"Dropping stale {msg_type} for node {key[1]} ({cid})")
+        state["pending"][key] = payload
+        return
+    state["inflight"].add(key)
+    _spawn_handler(cid, _run_latest(cid, key, payload, handler))
+
+
+async def _run_latest(cid: str, key: tuple[str, str], payload: dict, handler):
+    try:
+        while payload is not None:
+            try:
+                await handler(cid, payload)
+            except Exception as e:
+                # Keep draining: a bad payload must not strand the pending one
+                logger.error(f"Handler error ({cid}, {key[0]}): {e}")
+            state = _client_state.get(cid)
+            payload = state["pending"].pop(key, None) if state else None
+    finally:
+        state = _client_state.get(cid)
+        if state:
+            state["pending"].pop(key, None)
+            state["inflight"].discard(key)
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(ws: WebSocket):
     cid = await manager.connect(ws)
 
     _client_state[cid] = {
         "latest_frames": {},  # node_id -> latest base64 frame
+        "tasks": set(),       # in-flight handler tasks
+        "inflight": set(),    # (msg_type, node_id) currently being processed
+        "pending": {},        # (msg_type, node_id) -> newest waiting payload
     }
 
     try:
@@ -190,33 +302,44 @@ async def websocket_endpoint(ws: WebSocket):
 
             if msg_type == "frame":
                 await handle_frame(cid, payload)
-            elif msg_type == "detect":
-                await handle_detect(cid, payload)
-            elif msg_type == "vlm_analyze":
-                await handle_vlm_analyze(cid, payload)
+                continue
+
+            if msg_type == "detect":
+                _submit_latest(cid, msg_type, payload, handle_detect)
+                continue
+            if msg_type == "audio_analyze":
+                _submit_latest(cid, msg_type, payload, handle_audio_analyze)
+                continue
+
+            if msg_type == "vlm_analyze":
+                coro = handle_vlm_analyze(cid, payload)
             elif msg_type == "text_gen":
-                await handle_text_gen(cid, payload)
+                coro = handle_text_gen(cid, payload)
             elif msg_type == "describe_workflow":
-                await handle_describe_workflow(cid, payload)
-            elif msg_type == "audio_analyze":
-                await handle_audio_analyze(cid, payload)
+                coro = handle_describe_workflow(cid, payload)
             elif msg_type == "audio_llm_analyze":
-                await handle_audio_llm_analyze(cid, payload)
+                coro = handle_audio_llm_analyze(cid, payload)
             elif msg_type == "generate_workflow":
-                await handle_generate_workflow(cid, payload)
+                coro = handle_generate_workflow(cid, payload)
             elif msg_type == "send_email":
-                await handle_send_email(cid, payload)
+                coro = handle_send_email(cid, payload)
             elif msg_type == "send_sms":
-                await handle_send_sms(cid, payload)
+                coro = handle_send_sms(cid, payload)
             else:
                 logger.warning(f"Unknown message type: {msg_type}")
+                continue
+
+            _spawn_handler(cid, coro)
 
     except WebSocketDisconnect:
         pass
     except Exception as e:
         logger.error(f"WebSocket error ({cid}): {e}")
     finally:
-        _client_state.pop(cid, None)
+        state = _client_state.pop(cid, None)
+        if state:
+            for task in list(state["tasks"]):
+                task.cancel()
         brain.clear_client(cid)
         manager.disconnect(cid)
 
@@ -239,8 +362,6 @@ async def handle_frame(cid: str, payload: dict):
 
 async def handle_detect(cid: str, payload: dict):
     """Run YOLO object detection on a frame."""
-    import time
-
     image_b64 = payload.get("image", "")
     node_id = payload.get("node_id", "")
     conf = payload.get("confidence", 0.45)
@@ -253,7 +374,9 @@ async def handle_detect(cid: str, payload: dict):
         })
         return
 
-    watchdog = _get_watchdog()
+    loop = asyncio.get_event_loop()
+    # Already loaded on every frame after the first — skip the executor hop
+    watchdog = _watchdog or await loop.run_in_executor(None, _get_watchdog)
     if watchdog is None or not watchdog.loaded:
         await manager.send(cid, "detection_result", {
             "node_id": node_id,
@@ -263,14 +386,11 @@ async def handle_detect(cid: str, payload: dict):
         })
         return
 
-    loop = asyncio.get_event_loop()
-    watchdog.confidence = conf
-
-    t0 = time.perf_counter()
+    t0 = time.perf_counter_ns()
     detections = await loop.run_in_executor(
-        None, watchdog.detect_from_base64, image_b64
+        None, watchdog.detect_from_base64, image_b64, conf
     )
-    latency = (time.perf_counter() - t0) * 1000
+    latency = (time.perf_counter_ns() - t0) / 1e6
 
     await manager.send(cid, "detection_result", {
         "node_id": node_id,
@@ -283,8 +403,6 @@ async def handle_detect(cid: str, payload: dict):
 
 async def handle_audio_analyze(cid: str, payload: dict):
     """Run YamNet audio classification on a PCM chunk."""
-    import time
-
     audio_b64 = payload.get("audio", "")
     node_id = payload.get("node_id", "")
     conf = payload.get("confidence", 0.15)
@@ -297,7 +415,8 @@ async def handle_audio_analyze(cid: str, payload: dict):
         })
         return
 
-    detector = _get_audio_detector()
+    loop = asyncio.get_event_loop()
+    detector = _audio_detector or await loop.run_in_executor(None, _get_audio_detector)
     if detector is None or not detector.loaded:
         await manager.send(cid, "audio_result", {
             "node_id": node_id,
@@ -307,14 +426,11 @@ async def handle_audio_analyze(cid: str, payload: dict):
         })
         return
 
-    loop = asyncio.get_event_loop()
-    detector.confidence = conf
-
-    t0 = time.perf_counter()
+    t0 = time.perf_counter_ns()
     detections = await loop.run_in_executor(
-        None, detector.classify_from_base64, audio_b64
+        None, detector.classify_from_base64, audio_b64, 10, conf
     )
-    latency = (time.perf_counter() - t0) * 1000
+    latency = (time.perf_counter_ns() - t0) / 1e6
 
     await manager.send(cid, "audio_result", {
         "node_id": node_id,
@@ -339,10 +455,7 @@ async def handle_audio_llm_analyze(cid: str, payload: dict):
         })
         return
 
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(
-        None, brain.analyze_audio, audio_b64, prompt, cid
-    )
+    result = await _run_brain(brain.analyze_audio, audio_b64, prompt, cid)
 
     await manager.send(cid, "audio_llm_result", {
         "node_id": node_id,
@@ -367,10 +480,7 @@ async def handle_vlm_analyze(cid: str, payload: dict):
         })
         return
 
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(
-        None, brain.analyze_frame, image_b64, prompt, cid
-    )
+    result = await _run_brain(brain.analyze_frame, image_b64, prompt, cid)
 
     await manager.send(cid, "vlm_result", {
         "node_id": node_id,
@@ -385,9 +495,11 @@ async def handle_text_gen(cid: str, payload: dict):
     """Text generation via OmniNeural-4B (text-only, no image)."""
     prompt = payload.get("prompt", "")
     node_id = payload.get("node_id", "")
+    # Upstream-triggered runs repeat prompts and can share cached answers; the
+    # manual Generate button sends cache: false to get a new sample
+    use_cache = bool(payload.get("cache", True))
 
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, brain.generate_text, prompt)
+    result = await _run_brain(lambda: brain.generate_text(prompt, use_cache=use_cache))
 
     await manager.send(cid, "text_gen_result", {
         "node_id": node_id,
@@ -533,10 +645,8 @@ async def handle_describe_workflow(cid: str, payload: dict):
     )
 
     try:
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: brain.generate_text(prompt, max_tokens=512),
+        result = await _run_brain(
+            lambda: brain.generate_text(prompt, max_tokens=512, use_cache=True)
         )
         description = result.get("text", "").strip()
         if not description:
@@ -555,7 +665,7 @@ async def handle_describe_workflow(cid: str, payload: dict):
 
 # ─── Generate workflow from text (AI creates nodes + edges) ───
 
-VALID_NODE_TYPES = {"camera", "video", "detection", "visualLlm", "logic", "llm", "soundAction", "logAction", "notifyAction", "screenshotAction", "webhookAction", "emailAction", "smsAction", "mic", "audioDetect", "audioLlm", "audioFile"}
+VALID_NODE_TYPES = frozenset({"camera", "video", "detection", "visualLlm", "logic", "llm", "soundAction", "logAction", "notifyAction", "screenshotAction", "webhookAction", "emailAction", "smsAction", "mic", "audioDetect", "audioLlm", "audioFile"})
 
 GENERATE_WORKFLOW_PROMPT = """Output ONLY a single line of compact JSON. No newlines inside the JSON. No indentation. No markdown. No explanation.
 
@@ -607,64 +717,113 @@ _VALID_CONNECTIONS: dict[tuple[str, str], set[tuple[str, str]]] = {
 }
 
 
+_CODE_FENCE_OPEN = re.compile(r"^```\w*\s*")
+_CODE_FENCE_CLOSE = re.compile(r"\s*```\s*$")
+_WHITESPACE_RUN = re.compile(r"\s+")
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _json_object_stop():
+    """Build a generate_text stop_fn that fires once the first top-level
+    JSON object in the streamed text has closed (braces inside strings are
+    ignored). Anything the model writes after that is discarded by
+    _parse_workflow_json anyway, so there's no point generating it."""
+    depth = 0
+    started = False
+    in_string = False
+    escape = False
+
+    def stop(chunk: str) -> bool:
+        nonlocal depth, started, in_string, escape
+        for c in chunk:
+            if not started:
+                # Same scan as _parse_workflow_json: start at the first brace
+                if c == "{":
+                    started = True
+                    depth = 1
+            elif escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = not in_string
+            elif in_string:
+                continue
+            elif c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    return True
+        return False
+
+    return stop
+
+
 def _parse_workflow_json(raw: str):
     """Extract and validate nodes/edges from LLM output. Returns (nodes, edges)."""
-    import re
-
     text = raw.strip()
 
     # Strip markdown code fences (with or without closing fence)
-    text = re.sub(r"^```\w*\s*", "", text)
-    text = re.sub(r"\s*```\s*$", "", text)
+    text = _CODE_FENCE_OPEN.sub("", text)
+    text = _CODE_FENCE_CLOSE.sub("", text)
 
     # Collapse all whitespace (newlines, indentation) to single spaces to help parse pretty-printed JSON
-    text = re.sub(r"\s+", " ", text)
+    text = _WHITESPACE_RUN.sub(" ", text)
 
     # Extract the first JSON object { ... } even if there's junk around it
     brace_start = text.find("{")
     if brace_start == -1:
         return [], []
-    # Find matching closing brace by counting depth (skip braces inside strings)
-    depth = 0
-    brace_end = -1
-    in_string = False
-    escape = False
-    for i in range(brace_start, len(text)):
-        c = text[i]
-        if escape:
-            escape = False
-            continue
-        if c == "\\":
-            escape = True
-            continue
-        if c == '"':
-            in_string = not in_string
-            continue
-        if in_string:
-            continue
-        if c == "{":
-            depth += 1
-        elif c == "}":
-            depth -= 1
-            if depth == 0:
-                brace_end = i
-                break
-    if brace_end == -1:
-        # No matching close brace — truncated output
-        truncated = text[brace_start:]
-        # Try to close open arrays and braces
-        # Count open brackets
-        open_brackets = truncated.count("[") - truncated.count("]")
-        truncated += "]" * max(0, open_brackets) + "}" * max(0, depth)
-        text = truncated
-    else:
-        text = text[brace_start : brace_end + 1]
-
+    # Fast path: well-formed JSON parses straight from the first brace in one
+    # C-level pass, ignoring any trailing chatter after the object
     try:
-        data = json.loads(text)
+        data, _ = _JSON_DECODER.raw_decode(text, brace_start)
     except json.JSONDecodeError:
-        logger.warning(f"Workflow JSON parse failed: {text[:300]}")
-        return [], []
+        data = None
+
+    if not isinstance(data, dict):
+        # Find matching closing brace by counting depth (skip braces inside strings)
+        depth = 0
+        brace_end = -1
+        in_string = False
+        escape = False
+        for i in range(brace_start, len(text)):
+            c = text[i]
+            if escape:
+                escape = False
+                continue
+            if c == "\\":
+                escape = True
+                continue
+            if c == '"':
+                in_string = not in_string
+                continue
+            if in_string:
+                continue
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    brace_end = i
+                    break
+        if brace_end == -1:
+            # No matching close brace — truncated output
+            truncated = text[brace_start:]
+            # Try to close open arrays and braces
+            # Count open brackets
+            open_brackets = truncated.count("[") - truncated.count("]")
+            truncated += "]" * max(0, open_brackets) + "}" * max(0, depth)
+            text = truncated
+        else:
+            text = text[brace_start : brace_end + 1]
+
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            logger.warning(f"Workflow JSON parse failed: {text[:300]}")
+            return [], []
 
     nodes = data.get("nodes") or []
     edges = data.get("edges") or []
@@ -768,8 +927,6 @@ async def handle_generate_workflow(cid: str, payload: dict):
         })
         return
 
-    loop = asyncio.get_event_loop()
-
     # Try up to 2 times — the small model sometimes echoes the template or returns empty arrays
     MAX_ATTEMPTS = 2
     for attempt in range(MAX_ATTEMPTS):
@@ -786,9 +943,10 @@ async def handle_generate_workflow(cid: str, payload: dict):
                 )
                 logger.info("Workflow generation retry (attempt %d)", attempt + 1)
 
-            result = await loop.run_in_executor(
-                None,
-                lambda p=prompt: brain.generate_text(p, max_tokens=2048),
+            result = await _run_brain(
+                lambda p=prompt: brain.generate_text(
+                    p, max_tokens=2048, stop_fn=_json_object_stop()
+                )
             )
             raw = (result.get("text") or "").strip()
             logger.info(f"Workflow LLM raw output (attempt {attempt+1}): {raw[:300]}")
@@ -836,4 +994,7 @@ if __name__ == "__main__":
         port=port,
         reload=False,
         log_level="info",
+        # Fit the largest frame Watchdog accepts (base64 + JSON envelope) so
+        # it is rejected with a log line rather than a dropped connection.
+        ws_max_size=MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024,
     )
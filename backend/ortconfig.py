@@ -0,0 +1,25 @@
+"""
+ORT config — settings shared by the ONNX Runtime sessions.
+
+The YOLO (watchdog) and YamNet (audiodetector) sessions run side by side, so
+each gets half the cores (override with ARCFLOW_ORT_THREADS) instead of both
+claiming all of them.
+"""
+
+import os
+import logging
+
+logger = logging.getLogger("arcflow.ortconfig")
+
+
+def _ort_intra_op_threads() -> int:
+    """Intra-op threads per ORT session."""
+    try:
+        n = int(os.environ.get("ARCFLOW_ORT_THREADS", "0"))
+    except ValueError:
+        logger.warning("ARCFLOW_ORT_THREADS is not an integer — using the default")
+        n = 0
+    return n if n > 0 else max(1, (os.cpu_count() or 2) // 2)
+
+
+ORT_INTRA_OP_THREADS = _ort_intra_op_threads()
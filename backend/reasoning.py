@@ -7,15 +7,21 @@ Images are passed as base64 data URIs — no file I/O, no ffmpeg.
 """
 
 import os
+import json
 import time
+import hashlib
 import logging
+import threading
 import subprocess
+from collections import OrderedDict
+
 import httpx
 
 logger = logging.getLogger("arcflow.reasoning")
 
 NEXA_API = "http://127.0.0.1:18181"
 VLM_MODEL = "NexaAI/OmniNeural-4B"
+TEXT_CACHE_SIZE = 128
 
 
 def _is_repetitive_garbage(text: str, min_len: int = 20, repeat_threshold: float = 0.5) -> bool:
@@ -41,6 +47,12 @@ class ReasoningBrain:
         self._llm_loaded = False
         self._serve_proc = None
         self._audio_vlm = None
+        self._audio_vlm_lock = threading.Lock()
+        # LRU of prompt digest -> generated text (see generate_text)
+        self._text_cache: OrderedDict[bytes, str] = OrderedDict()
+        self._text_cache_lock = threading.Lock()
+        self._text_cache_hits = 0
+        self._text_cache_misses = 0
 
     # ── Start / check nexa serve ──────────────────────────────────
 
@@ -160,13 +172,16 @@ class ReasoningBrain:
         """Lazy-load a dedicated VLM instance for audio via the Python SDK."""
         if self._audio_vlm is not None:
             return
-        try:
-            from nexaai import VLM, ModelConfig
-            self._audio_vlm = VLM.from_(model=VLM_MODEL, config=ModelConfig())
-            logger.info("Audio VLM (Python SDK) loaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to load Audio VLM via Python SDK: {e}")
-            self._audio_vlm = None
+        with self._audio_vlm_lock:
+            if self._audio_vlm is not None:
+                return  # another thread loaded it while we waited
+            try:
+                from nexaai import VLM, ModelConfig
+                self._audio_vlm = VLM.from_(model=VLM_MODEL, config=ModelConfig())
+                logger.info("Audio VLM (Python SDK) loaded successfully")
+            except Exception as e:
+                logger.error(f"Failed to load Audio VLM via Python SDK: {e}")
+                self._audio_vlm = None
 
     def analyze_audio(
         self,
@@ -192,11 +207,14 @@ class ReasoningBrain:
             import numpy as np
             raw = b64mod.b64decode(base64_pcm)
             pcm_f32 = np.frombuffer(raw, dtype=np.float32)
-            logger.info(f"Audio PCM: {len(pcm_f32)} samples, "
-                        f"rms={np.sqrt(np.mean(pcm_f32**2)):.4f}, "
-                        f"max={np.max(np.abs(pcm_f32)):.4f}")
-            pcm_f32 = np.clip(pcm_f32, -1.0, 1.0)
-            pcm_i16 = (pcm_f32 * 32767).astype(np.int16)
+            # dot/min/max reduce without materializing pcm**2 or |pcm|
+            peak = max(pcm_f32.max(), -pcm_f32.min())
+            rms = np.sqrt(np.dot(pcm_f32, pcm_f32) / len(pcm_f32))
+            logger.info(f"Audio PCM: {len(pcm_f32)} samples, rms={rms:.4f}, max={peak:.4f}")
+            # One float copy (frombuffer is read-only), scaled in place, then cast
+            scaled = np.clip(pcm_f32, -1.0, 1.0)
+            scaled *= 32767
+            pcm_i16 = scaled.astype(np.int16)
 
             cache_dir = os.path.join(os.path.dirname(__file__), "_vlm_cache")
             os.makedirs(cache_dir, exist_ok=True)
@@ -259,35 +277,98 @@ class ReasoningBrain:
 
     # ── LLM text generation via REST API ──────────────────────────
 
-    def generate_text(self, prompt: str, max_tokens: int = 256) -> dict:
+    def generate_text(
+        self, prompt: str, max_tokens: int = 256, use_cache: bool = False, stop_fn=None,
+    ) -> dict:
+        """Text-only completion. With use_cache, an identical prompt returns
+        the previous answer instead of running the model again. With stop_fn,
+        the reply is streamed and generation ends as soon as stop_fn(chunk)
+        returns True for a newly received chunk of text."""
         t0 = time.perf_counter()
 
         if not self._llm_loaded:
             return {"text": "[LLM not loaded]", "latency_ms": 0}
 
+        key = None
+        if use_cache:
+            key = hashlib.blake2b(f"{max_tokens}\0{prompt}".encode(), digest_size=16).digest()
+            with self._text_cache_lock:
+                text = self._text_cache.get(key)
+                if text is not None:
+                    self._text_cache.move_to_end(key)
+                    self._text_cache_hits += 1
+                    dt = (time.perf_counter() - t0) * 1000
+                    logger.info(f"LLM cache hit: {dt:.1f}ms")
+                    return {"text": text, "latency_ms": round(dt, 1)}
+                self._text_cache_misses += 1
+
         payload = {
             "model": VLM_MODEL,
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": max_tokens,
-            "stream": False,
+            "stream": stop_fn is not None,
         }
 
         try:
-            resp = httpx.post(
-                f"{NEXA_API}/v1/chat/completions",
-                json=payload,
-                timeout=120,
-            )
-            data = resp.json()
-            text = data["choices"][0]["message"]["content"]
+            if stop_fn is not None:
+                text = self._stream_completion(payload, stop_fn)
+            else:
+                resp = httpx.post(
+                    f"{NEXA_API}/v1/chat/completions",
+                    json=payload,
+                    timeout=120,
+                )
+                data = resp.json()
+                text = data["choices"][0]["message"]["content"]
         except Exception as e:
             logger.error(f"LLM API error: {e}")
             text = f"[LLM error: {e}]"
+            key = None  # never cache failures
+
+        if key is not None and text:
+            with self._text_cache_lock:
+                self._text_cache[key] = text
+                if len(self._text_cache) > TEXT_CACHE_SIZE:
+                    self._text_cache.popitem(last=False)
 
         dt = (time.perf_counter() - t0) * 1000
         logger.info(f"LLM done: {dt:.0f}ms")
         return {"text": text, "latency_ms": round(dt, 1)}
 
+    @staticmethod
+    def _stream_completion(payload: dict, stop_fn) -> str:
+        """Read an SSE chat completion until it finishes or stop_fn fires.
+        Leaving the stream early closes the connection, which aborts the
+        rest of the generation on the server."""
+        parts: list[str] = []
+        with httpx.stream(
+            "POST", f"{NEXA_API}/v1/chat/completions", json=payload, timeout=120,
+        ) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                chunk = line[5:].strip()
+                if chunk == "[DONE]":
+                    break
+                choice = (json.loads(chunk).get("choices") or [{}])[0]
+                delta = (choice.get("delta") or {}).get("content") or ""
+                if not delta:
+                    continue
+                parts.append(delta)
+                if stop_fn(delta):
+                    logger.info(f"LLM stream stopped early after {sum(map(len, parts))} chars")
+                    break
+        return "".join(parts)
+
+    def cache_stats(self) -> dict:
+        with self._text_cache_lock:
+            return {
+                "size": len(self._text_cache),
+                "hits": self._text_cache_hits,
+                "misses": self._text_cache_misses,
+            }
+
     def shutdown(self):
         if self._serve_proc:
             logger.info("Stopping nexa serve …")
@@ -16,14 +16,31 @@ Supports two model formats:
 
 import io
 import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
 from PIL import Image
 
+from ortconfig import ORT_INTRA_OP_THREADS
+
 logger = logging.getLogger("arcflow.watchdog")
 
+# libjpeg-turbo decodes straight into an RGB ndarray (SIMD iDCT + colour convert)
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except (ImportError, Exception):
+    _tj = None
+
+try:
+    import pybase64 as b64  # SIMD base64, same API as the stdlib module
+except ImportError:
+    import base64 as b64
+
 # COCO class names (80 classes for YOLO)
 COCO_CLASSES = [
     "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train",
@@ -43,10 +60,20 @@ COCO_CLASSES = [
 
 INPUT_SIZE = 640
 NMS_IOU_THRESHOLD = 0.5
-
-
-def _nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = NMS_IOU_THRESHOLD) -> list[int]:
-    """Greedy Non-Maximum Suppression. boxes: Nx4 (x1,y1,x2,y2), scores: N."""
+MAX_DETECTIONS = 20
+RESULT_CACHE_SIZE = 32
+MAX_IMAGE_BYTES = 16 * 1024 * 1024
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+
+def _nms(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    iou_threshold: float = NMS_IOU_THRESHOLD,
+    max_det: int = MAX_DETECTIONS,
+) -> list[int]:
+    """Greedy Non-Maximum Suppression. boxes: Nx4 (x1,y1,x2,y2), scores: N.
+    Stops once max_det boxes are kept — later ones could only score lower."""
     if len(boxes) == 0:
         return []
 
@@ -63,7 +90,7 @@ def _nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = NMS_IOU_T
         i = order[0]
         keep.append(int(i))
 
-        if len(order) == 1:
+        if len(order) == 1 or len(keep) >= max_det:
             break
 
         rest = order[1:]
@@ -80,6 +107,65 @@ def _nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = NMS_IOU_T
     return keep
 
 
+def _build_detections(
+    boxes: np.ndarray, scores: np.ndarray, class_ids: np.ndarray, keep: list[int]
+) -> list[dict]:
+    """Detection dicts for the NMS survivors, best score first.
+
+    Rounding runs once over the kept rows in float64 (approximately matching
+    Python's round(); halfway cases can differ in the last digit) and
+    .tolist() hands back plain Python numbers.
+    """
+    idx = np.asarray(keep, dtype=np.intp)
+    bboxes = np.round(boxes[idx].astype(np.float64), 4).tolist()
+    confs = np.round(scores[idx].astype(np.float64), 3).tolist()
+    n_classes = len(COCO_CLASSES)
+    return [
+        {
+            "label": COCO_CLASSES[c] if c < n_classes else f"class_{c}",
+            "confidence": conf,
+            "bbox": bbox,
+        }
+        for c, conf, bbox in zip(class_ids[idx].tolist(), confs, bboxes)
+    ]
+
+
+def _decode_image(img_bytes: bytes) -> np.ndarray | None:
+    """Decode image bytes to an RGB HWC array. Returns None if undecodable.
+
+    JPEG goes through libjpeg-turbo when available; anything else (or a JPEG
+    it rejects) goes to PIL, whose Image.open fails on the header alone for
+    non-image payloads.
+    """
+    is_jpeg = img_bytes[:3] == JPEG_MAGIC
+
+    if _tj is not None and is_jpeg:
+        try:
+            # Let libjpeg-turbo downscale inside the iDCT (1/2, 1/4, 1/8) while
+            # the frame stays >= INPUT_SIZE on both sides — the model input is
+            # 640x640 anyway, so a full-resolution decode is wasted work.
+            width, height = _tj.decode_header(img_bytes)[:2]
+            scale = None
+            for denom in (8, 4, 2):
+                if min(width, height) // denom >= INPUT_SIZE:
+                    scale = (1, denom)
+                    break
+            return _tj.decode(img_bytes, pixel_format=TJPF_RGB, scaling_factor=scale)
+        except Exception:
+            pass  # Corrupt or exotic JPEG — let PIL have a go
+
+    try:
+        pil_img = Image.open(io.BytesIO(img_bytes))
+        # JPEG only: DCT downscaling with the same rule as the turbojpeg path
+        # (stay >= INPUT_SIZE on both sides); no-op for other formats
+        pil_img.draft("RGB", (INPUT_SIZE, INPUT_SIZE))
+        if pil_img.mode != "RGB":
+            pil_img = pil_img.convert("RGB")
+    except Exception:
+        return None
+    return np.asarray(pil_img)  # views the exported buffer, no second copy
+
+
 class Watchdog:
     """Lightweight ONNX object-detection tier (Tier 1)."""
 
@@ -90,6 +176,10 @@ class Watchdog:
         self._loaded = False
         self._qnn_format = False  # True if Qualcomm AI Hub precompiled model
         self._use_cpu = use_cpu
+        self._tls = threading.local()  # per-thread input buffers (detect runs on executor threads)
+        # LRU of recent results keyed on (payload digest, confidence)
+        self._result_cache: OrderedDict[tuple[bytes, float], list[dict]] = OrderedDict()
+        self._result_cache_lock = threading.Lock()
 
         if model_path and Path(model_path).exists():
             self._load_model(model_path)
@@ -104,6 +194,7 @@ class Watchdog:
             # Build provider list with QNN-specific options
             provider_options = []
             preferred = []
+            ctx_to_write = None  # set when QNN must compile and should dump its context
 
             if self._use_cpu:
                 logger.info("CPU-only mode requested — skipping QNN/DML providers")
@@ -122,15 +213,18 @@ class Watchdog:
                     "backend_path": "QnnHtp.dll",           # Target Qualcomm HTP (NPU)
                     "htp_performance_mode": "burst",         # Max NPU performance
                     "htp_graph_finalization_optimization_mode": "3",  # Highest optimization
-                    "enable_htp_fp16_precision": "1",        # FP16 for speed
-                    "ep_context_enable": "1",                # Enable context caching
-                    "ep_context_file_path": ctx_binary,      # Cache path
                 }
+                # FP16 for speed on float exports; int8 (QDQ) runs natively on the HTP
+                if "int8" not in Path(path).stem:
+                    qnn_opts["enable_htp_fp16_precision"] = "1"
 
                 # If a cached context binary exists, load it directly
                 if Path(ctx_binary).exists():
                     logger.info(f"Loading cached QNN context binary: {ctx_binary}")
                     path = ctx_binary  # Load from cache instead of re-compiling
+                else:
+                    logger.info(f"No QNN context cache — compiling graph, will save to {ctx_binary}")
+                    ctx_to_write = ctx_binary
 
                 provider_options.append(qnn_opts)
             else:
@@ -146,6 +240,15 @@ class Watchdog:
 
             sess_opts = ort.SessionOptions()
             sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            sess_opts.intra_op_num_threads = ORT_INTRA_OP_THREADS
+            sess_opts.inter_op_num_threads = 1
+            sess_opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            sess_opts.enable_mem_pattern = True   # fixed input shapes → reuse the allocation plan
+            sess_opts.enable_cpu_mem_arena = True
+            if ctx_to_write:
+                # EP context caching is a session config entry, not a QNN provider option
+                sess_opts.add_session_config_entry("ep.context_enable", "1")
+                sess_opts.add_session_config_entry("ep.context_file_path", ctx_to_write)
 
             self.session = ort.InferenceSession(
                 path,
@@ -159,7 +262,11 @@ class Watchdog:
 
             # Detect model format from output names
             output_names = [o.name for o in self.session.get_outputs()]
-            input_shape = self.session.get_inputs()[0].shape
+            input_info = self.session.get_inputs()[0]
+            input_shape = input_info.shape
+            # Cached so the hot path doesn't re-query the session per call
+            self._input_name = input_info.name
+            self._output_names = output_names
 
             if "boxes" in output_names or "scores" in output_names:
                 self._qnn_format = True
@@ -170,7 +277,7 @@ class Watchdog:
 
             logger.info(f"Watchdog model loaded: {path}")
             logger.info(f"  Active providers: {active_providers}")
-            logger.info(f"  Input: {self.session.get_inputs()[0].name} {input_shape}")
+            logger.info(f"  Input: {self._input_name} {input_shape}")
             logger.info(f"  Outputs: {output_names}")
 
             if "QNNExecutionProvider" in active_providers:
@@ -185,20 +292,49 @@ class Watchdog:
     def loaded(self) -> bool:
         return self._loaded
 
+    def _input_buffer(self, shape: tuple[int, ...]) -> np.ndarray:
+        """Reusable float32 input tensor for the calling thread.
+
+        The model input shape is fixed, so the tensor is allocated once per
+        thread and overwritten in place on every frame.
+        """
+        buf = getattr(self._tls, "input_buf", None)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=np.float32)
+            self._tls.input_buf = buf
+        return buf
+
+    def _run_bound(self, input_tensor: np.ndarray) -> list[np.ndarray]:
+        """Run the session through an IOBinding tied to this thread's input buffer.
+
+        The binding is created once per buffer, so ORT reads the preprocessed
+        tensor in place instead of copying the feed into its own OrtValue.
+        """
+        io = getattr(self._tls, "io_binding", None)
+        if io is None or getattr(self._tls, "bound_input", None) is not input_tensor:
+            io = self.session.io_binding()
+            io.bind_cpu_input(self._input_name, input_tensor)
+            for name in self._output_names:
+                io.bind_output(name, "cpu")
+            self._tls.io_binding = io
+            self._tls.bound_input = input_tensor
+        self.session.run_with_iobinding(io)
+        return io.copy_outputs_to_cpu()
+
     def _preprocess_nchw(self, img_rgb: np.ndarray) -> np.ndarray:
         """Standard ONNX: resize, normalize, HWC→CHW → [1, 3, H, W]."""
         pil_img = Image.fromarray(img_rgb).resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR)
-        img = np.array(pil_img, dtype=np.float32) / 255.0
-        img = np.transpose(img, (2, 0, 1))  # HWC → CHW
-        img = np.expand_dims(img, 0)          # → NCHW
-        return img
+        buf = self._input_buffer((1, 3, INPUT_SIZE, INPUT_SIZE))
+        # Cast, normalize and HWC → CHW in a single pass into the reused tensor
+        np.divide(np.asarray(pil_img).transpose(2, 0, 1), np.float32(255.0), out=buf[0])
+        return buf
 
     def _preprocess_nhwc(self, img_rgb: np.ndarray) -> np.ndarray:
         """QNN precompiled: resize, normalize, keep HWC → [1, H, W, 3]."""
         pil_img = Image.fromarray(img_rgb).resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR)
-        img = np.array(pil_img, dtype=np.float32) / 255.0
-        img = np.expand_dims(img, 0)  # → NHWC [1, 640, 640, 3]
-        return img
+        buf = self._input_buffer((1, INPUT_SIZE, INPUT_SIZE, 3))
+        np.divide(np.asarray(pil_img), np.float32(255.0), out=buf[0])
+        return buf
 
     def _postprocess_raw(self, output: np.ndarray, conf_threshold: float) -> list[dict]:
         """
@@ -207,50 +343,33 @@ class Watchdog:
         """
         predictions = output[0]  # [84, 8400]
 
-        if predictions.shape[0] == 84:
-            predictions = predictions.T  # → [8400, 84]
+        if predictions.shape[0] != 84:
+            predictions = predictions.T  # [8400, 84] exports → [84, 8400]
 
-        boxes = predictions[:, :4]
-        scores = predictions[:, 4:]
+        # Stay in the native row layout: each attribute is one contiguous row,
+        # so no transposed copy of the whole 84x8400 block is needed
+        scores = predictions[4:]  # [80, 8400]
 
-        max_scores = np.max(scores, axis=1)
+        max_scores = np.max(scores, axis=0)
         mask = max_scores > conf_threshold
 
-        boxes = boxes[mask]
-        scores = scores[mask]
         max_scores = max_scores[mask]
-        class_ids = np.argmax(scores, axis=1)
+        class_ids = np.argmax(scores[:, mask], axis=0)
 
         # Convert cx/cy/w/h to x1/y1/x2/y2 for NMS
-        cx, cy, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
-        nms_boxes = np.stack([
-            (cx - w / 2) / INPUT_SIZE,
-            (cy - h / 2) / INPUT_SIZE,
-            (cx + w / 2) / INPUT_SIZE,
-            (cy + h / 2) / INPUT_SIZE,
-        ], axis=1)
+        cx, cy, w, h = predictions[:4, mask]
+        half_w = w / 2
+        half_h = h / 2
+        nms_boxes = np.empty((len(cx), 4), dtype=cx.dtype)
+        np.subtract(cx, half_w, out=nms_boxes[:, 0])
+        np.subtract(cy, half_h, out=nms_boxes[:, 1])
+        np.add(cx, half_w, out=nms_boxes[:, 2])
+        np.add(cy, half_h, out=nms_boxes[:, 3])
+        nms_boxes /= INPUT_SIZE  # normalize all four coords in one pass
 
         keep = _nms(nms_boxes, max_scores)
 
-        detections = []
-        for i in keep:
-            x1, y1, x2, y2 = nms_boxes[i]
-            class_id = int(class_ids[i])
-            label = COCO_CLASSES[class_id] if class_id < len(COCO_CLASSES) else f"class_{class_id}"
-
-            detections.append({
-                "label": label,
-                "confidence": round(float(max_scores[i]), 3),
-                "bbox": [
-                    round(float(x1), 4),
-                    round(float(y1), 4),
-                    round(float(x2), 4),
-                    round(float(y2), 4),
-                ],
-            })
-
-        detections.sort(key=lambda d: d["confidence"], reverse=True)
-        return detections[:20]
+        return _build_detections(nms_boxes, max_scores, class_ids, keep)
 
     def _postprocess_qnn(self, outputs: list[np.ndarray], conf_threshold: float) -> list[dict]:
         """
@@ -268,38 +387,24 @@ class Watchdog:
         scores = scores[mask]
         class_ids = class_ids[mask]
 
-        # Normalize boxes and apply NMS
-        nms_boxes = boxes.copy()
-        nms_boxes[:, 0] /= INPUT_SIZE
-        nms_boxes[:, 1] /= INPUT_SIZE
-        nms_boxes[:, 2] /= INPUT_SIZE
-        nms_boxes[:, 3] /= INPUT_SIZE
+        # Normalize boxes and apply NMS (boxes[mask] is already a private copy)
+        nms_boxes = boxes
+        nms_boxes /= INPUT_SIZE
 
         keep = _nms(nms_boxes, scores)
 
-        detections = []
-        for i in keep:
-            class_id = int(class_ids[i])
-            label = COCO_CLASSES[class_id] if class_id < len(COCO_CLASSES) else f"class_{class_id}"
-
-            detections.append({
-                "label": label,
-                "confidence": round(float(scores[i]), 3),
-                "bbox": [
-                    round(float(nms_boxes[i, 0]), 4),
-                    round(float(nms_boxes[i, 1]), 4),
-                    round(float(nms_boxes[i, 2]), 4),
-                    round(float(nms_boxes[i, 3]), 4),
-                ],
-            })
-
-        detections.sort(key=lambda d: d["confidence"], reverse=True)
-        return detections[:20]
-
-    def detect(self, frame_rgb: np.ndarray) -> list[dict]:
-        """Run full detection pipeline on an RGB frame (HWC numpy array)."""
+        return _build_detections(nms_boxes, scores, class_ids, keep)
+
+    def detect(self, frame_rgb: np.ndarray, conf: float | None = None) -> list[dict]:
+        """Run full detection pipeline on an RGB frame (HWC numpy array).
+
+        conf overrides self.confidence for this call only, so concurrent
+        callers with different thresholds don't race on the shared attribute.
+        """
         if not self._loaded:
             return []
+        if conf is None:
+            conf = self.confidence
 
         t0 = time.perf_counter()
 
@@ -309,33 +414,56 @@ class Watchdog:
         else:
             input_tensor = self._preprocess_nchw(frame_rgb)
 
-        input_name = self.session.get_inputs()[0].name
-        outputs = self.session.run(None, {input_name: input_tensor})
+        outputs = self._run_bound(input_tensor)
 
         # Postprocess based on model format
         if self._qnn_format:
-            detections = self._postprocess_qnn(outputs, self.confidence)
+            detections = self._postprocess_qnn(outputs, conf)
         else:
-            detections = self._postprocess_raw(outputs[0], self.confidence)
+            detections = self._postprocess_raw(outputs[0], conf)
 
         dt = (time.perf_counter() - t0) * 1000
         logger.debug(f"Watchdog inference: {dt:.1f}ms, {len(detections)} detections")
 
         return detections
 
-    def detect_from_base64(self, base64_str: str) -> list[dict]:
+    def detect_from_base64(self, base64_str: str, conf: float | None = None) -> list[dict]:
         """Convenience: decode base64 JPEG → detect."""
-        import base64 as b64
+        if conf is None:
+            conf = self.confidence
 
         # Strip data URI prefix if present
         if "," in base64_str:
             base64_str = base64_str.split(",", 1)[1]
 
-        img_bytes = b64.b64decode(base64_str)
+        # Reject oversized payloads before allocating the decoded buffer
+        if len(base64_str) > MAX_IMAGE_BYTES * 4 // 3 + 4:
+            logger.warning(f"Frame too large ({len(base64_str)} base64 chars) — skipped")
+            return []
+
+        # Identical frames are common: a camera capturing slower than the
+        # detect interval, a paused video, or several Detect nodes on one
+        # camera. Serve those from the cache and skip decode + inference.
+        # (Exact match only — a perceptual hash would return stale boxes for
+        # small moving objects.)
+        key = (hashlib.blake2b(base64_str.encode(), digest_size=16).digest(), conf)
+        with self._result_cache_lock:
+            cached = self._result_cache.get(key)
+            if cached is not None:
+                self._result_cache.move_to_end(key)
+                return cached
+
         try:
-            pil_img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        except Exception:
+            img_bytes = b64.b64decode(base64_str)
+        except ValueError:
+            return []
+        frame_rgb = _decode_image(img_bytes)
+        if frame_rgb is None:
             return []
+        detections = self.detect(frame_rgb, conf)
 
-        frame_rgb = np.array(pil_img)
-        return self.detect(frame_rgb)
+        with self._result_cache_lock:
+            self._result_cache[key] = detections
+            if len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+        return detections
@@ -91,7 +91,8 @@ export default function LlmNode({ id, selected, data }: NodeProps) {
     processingRef.current = true;
     setProcessing(true);
     setOutput(null);
-    pipelineSocket.sendTextGen(fullPrompt, id);
+    // Fresh sample on every click — bypass the backend's response cache
+    pipelineSocket.sendTextGen(fullPrompt, id, false);
   }, [manualPrompt, systemPrompt, id]);
 
   const hasUpstream = !!sourceNodeId;
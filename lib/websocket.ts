@@ -107,12 +107,12 @@ export class PipelineSocket {
     );
   }
 
-  sendTextGen(prompt: string, nodeId: string) {
+  sendTextGen(prompt: string, nodeId: string, cache = true) {
     if (this.ws?.readyState !== WebSocket.OPEN) return;
     this.ws.send(
       JSON.stringify({
         type: "text_gen",
-        payload: { prompt, node_id: nodeId },
+        payload: { prompt, node_id: nodeId, cache },
       })
     );
   }